@@ -24,6 +24,10 @@ class Arg_parser():
         parser.add_argument("--lamb", type=float, default=5.0)
         parser.add_argument("--process_noise", type=float, default=1e-4)
         parser.add_argument("--measurement_noise", type=float, default=1e-2)
+        parser.add_argument("--state_dtype", type=str, choices=["float32", "bfloat16", "float16"], default="float32")
+        parser.add_argument("--filter_skip", type=str, nargs="*", default=[]) # e.g. token_embeddings.weight position_embeddings.weight
+        parser.add_argument("--bf16", action='store_true') # bfloat16 autocast for the forward pass and loss
+        parser.add_argument("--tf32", action='store_true') # TF32 float32 matmuls on Ampere+ GPUs
 
         # Smoother
         """
@@ -58,6 +62,7 @@ class Arg_parser():
         # for low-rank-update training
         parser.add_argument("--enable_lr_update", action = "store_true")
         parser.add_argument("--update_rank_percentage", type = float, default=0.1)
+        parser.add_argument("--randomized_svd", action = "store_true") # approximate, faster projection for fast-decaying spectra
 
 
         # Ablation studies
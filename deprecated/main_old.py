@@ -1,9 +1,12 @@
 import math
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 from itertools import permutations
-import copy
 
+import matplotlib
+matplotlib.use("Agg") # non-interactive, files only
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 from tqdm import tqdm
 
 import torch
@@ -11,6 +14,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 from grokfast import *
+from tools import plot_train_val, snapshot_state_dict
 
 
 class Block(nn.Module):
@@ -29,14 +33,16 @@ class Block(nn.Module):
         )
 
     def forward(self, x):
-        attn_mask = torch.full(
-            (len(x), len(x)), -float("Inf"), device=x.device, dtype=x.dtype
-        )
-        attn_mask = torch.triu(attn_mask, diagonal=1)
-        attn_mask[torch.isnan(attn_mask)] = 0.0 # fixes all 'nan' on 'mps' device
-
+        # Same projections as nn.MultiheadAttention (so parameters, init and
+        # checkpoints are unchanged), but routed through the fused
+        # scaled_dot_product_attention kernel with its built-in causal mask.
+        T, B, C = x.shape
+        H = self.attn.num_heads
         x = self.ln_1(x)
-        a, _ = self.attn(x, x, x, attn_mask=attn_mask, need_weights=False)
+        qkv = F.linear(x, self.attn.in_proj_weight, self.attn.in_proj_bias)
+        q, k, v = qkv.view(T, B, 3, H, C // H).permute(2, 1, 3, 0, 4)
+        a = F.scaled_dot_product_attention(q, k, v, is_causal=True)
+        a = self.attn.out_proj(a.permute(2, 0, 1, 3).reshape(T, B, C))
         x = x + a
         m = self.mlp(self.ln_2(x))
         x = x + m
@@ -73,28 +79,45 @@ class Decoder(nn.Module):
 def multiplication_mod_p_data(p, eq_token, op_token):
     """x◦y = x/y (mod p) for 0 ≤ x < p, 0 < y < p
     """
-    x = torch.arange(p)
-    y = torch.arange(1, p)
-    x, y = torch.cartesian_prod(x, y).T
+    x, y = torch.meshgrid(torch.arange(p), torch.arange(1, p), indexing='ij')
+    x = x.reshape(-1)
+    y = y.reshape(-1)
 
-    eq = torch.ones_like(x) * eq_token
-    op = torch.ones_like(x) * op_token
-    result = (x**2 + x * y + y**2 ) % p
+    eq = torch.full_like(x, eq_token)
+    op = torch.full_like(x, op_token)
+    result = (x * x).add_(x * y).add_(y * y).remainder_(p)
 
     # "All of our experiments used a small transformer trained on datasets of
     # equations of the form a◦b = c, where each of “a”, “◦”, “b”, “=”, and “c”
     # is a seperate token"
     return torch.stack([x, op, y, eq, result])
 
+@torch.no_grad()
 def compute_sparsity(model):
-    total_params = 0
-    zero_params = 0
-    for param in model.parameters():
-        total_params += param.numel()
-        zero_params += (param == 0).sum().item()
-    sparsity = zero_params / total_params
+    params = list(model.parameters())
+    total_params = sum(param.numel() for param in params)
+    # The L0 norm of a tensor is its number of non-zeros; reduce all of them on
+    # the device so there is a single host sync.
+    nonzero_params = torch.stack(torch._foreach_norm(params, 0)).sum().item()
+    sparsity = 1 - nonzero_params / total_params
     return sparsity
 
+def plot_norm_distance(fig, steps, norms, distances, norm_name, filename):
+    """Plot a parameter norm and its distance from the initial weights to
+    `filename` on the reusable Figure `fig`.
+    """
+    ax = fig.subplots()
+    ax.plot(steps, norms, label=f"{norm_name} Norm")
+    ax.plot(steps, distances, label=f"{norm_name} Distance from Initial")
+    ax.set_xlabel("Optimization Steps")
+    ax.set_ylabel(f"{norm_name} Norm")
+    ax.set_xscale("log", base=10)
+    ax.set_yscale("log", base=10)
+    ax.set_title(f"{norm_name} Norm and Distance")
+    ax.legend()
+    fig.savefig(filename)
+    fig.clear()
+
 def main(args):
     torch.manual_seed(args.seed)
 
@@ -117,18 +140,35 @@ def main(args):
     print(model)
     print(f'Total number of parameters: {nparams}')
 
-    data = multiplication_mod_p_data(args.p, eq_token, op_token)
+    # The model is tiny, so each step is bound by kernel launches rather than
+    # FLOPs; let torch.compile fuse the ops and replay them with CUDA graphs.
+    # The gradient filters and the optimizer keep using the eager `model`,
+    # which shares its parameters with `compiled_model`.
+    # Shapes are kept static: there are only two batch sizes per split (full and
+    # the last, partial one), so each gets its own graph that is recorded once
+    # and replayed, instead of a recompile with symbolic shapes.
+    compiled_model = torch.compile(model, mode="reduce-overhead", fullgraph=True, dynamic=False)
+
+    # The whole dataset is tiny, so keep it on the device for the entire run.
+    data = multiplication_mod_p_data(args.p, eq_token, op_token).to(device)
 
-    train_idx, valid_idx = torch.randperm(data.shape[1]).split(data.shape[1] // 2)
+    train_idx, valid_idx = torch.randperm(data.shape[1], device=device).split(data.shape[1] // 2)
     train_data, valid_data = data[:, train_idx], data[:, valid_idx]
 
     # For most experiments we used AdamW optimizer with learning rate 10−3,
     # weight decay 1, β1 = 0.9, β2 = 0.98
+    # Batch the per-parameter update kernels: the fused Adam(W) kernel on CUDA,
+    # the multi-tensor (foreach) implementation everywhere else.
+    if device.type == "cuda" and args.optimizer in ("Adam", "AdamW"):
+        optimizer_kwargs = {"fused": True}
+    else:
+        optimizer_kwargs = {"foreach": True}
     optimizer = getattr(torch.optim, args.optimizer)(
         model.parameters(),
         lr=args.lr,
         weight_decay=args.weight_decay,
         betas=(args.beta1, args.beta2),
+        **optimizer_kwargs,
     )
 
     #  linear learning rate warmup over the first 20 updates
@@ -140,39 +180,50 @@ def main(args):
 
     its, train_acc, val_acc, train_loss, val_loss = [], [], [], [], []
     grads = None
+    filter_skip = set(args.filter_skip)
     i = 0
 
-    # For logging network weights.
+    # For logging network weights. Snapshots are staged in one flat (pinned on
+    # CUDA) buffer, so each is a single device-to-host transfer and one clone.
     net_its, nets = [], []
+    snapshot_buffer = torch.empty(
+        sum(t.numel() for t in model.state_dict().values()), pin_memory=device.type == "cuda"
+    )
 
-    initial_state = copy.deepcopy(model.state_dict())
-    init_vector = torch.cat([p.view(-1) for p in initial_state.values()])
+    params = list(model.parameters())
+    init_params = [p.detach().clone() for p in params]
 
     param_norms_l2, param_distances_l2 = [], []
     param_norms_l1, param_distances_l1 = [], []
     sparsity_log = []
 
+    # Plots are rendered on a background thread so training doesn't wait on them.
+    # A single worker renders them one at a time, so they can share one Figure.
+    plot_executor = ThreadPoolExecutor(max_workers=1)
+    plot_futures = []
+    plot_figure = Figure()
+
     for e in tqdm(range(int(args.budget) // steps_per_epoch)):
 
         # randomly shuffle train data
-        train_data = train_data[:, torch.randperm(train_data.shape[1])]
+        train_data = train_data[:, torch.randperm(train_data.shape[1], device=device)]
 
         for data, is_train in [(train_data, True), (valid_data, False)]:
 
             model.train(is_train)
-            total_loss = 0
-            total_acc = 0
+            # Accumulate on the device; syncing with .item() every batch stalls the stream.
+            total_loss = torch.zeros((), device=device)
+            total_acc = torch.zeros((), device=device)
 
-            # torch.split faster than dataloader with tensor
-            dl = torch.split(data, args.batch_size, dim=1)
-            for input in dl:
-                input = input.to(device)
+            # slicing views is faster than dataloader with tensor
+            for start in range(0, data.shape[1], args.batch_size):
+                input = data[:, start:start + args.batch_size]
 
                 with torch.set_grad_enabled(is_train):
-                    logits = model(input[:-1])
+                    logits = compiled_model(input[:-1])
                     # calculate loss only on the answer part of the equation (last element
                     loss = F.cross_entropy(logits[-1], input[-1])
-                    total_loss += loss.item() * input.shape[-1]
+                    total_loss += loss.detach() * input.shape[-1]
 
                 if is_train:
                     model.zero_grad()
@@ -185,11 +236,11 @@ def main(args):
                     if args.filter == "none":
                         pass
                     elif args.filter == "ma":
-                        grads = gradfilter_ma(model, grads=grads, window_size=args.window_size, lamb=args.lamb, trigger=trigger)
+                        grads = gradfilter_ma(model, grads=grads, window_size=args.window_size, lamb=args.lamb, trigger=trigger, skip=filter_skip)
                     elif args.filter == "ema":
-                        grads = gradfilter_ema(model, grads=grads, alpha=args.alpha, lamb=args.lamb, trigger = trigger)
+                        grads = gradfilter_ema(model, grads=grads, alpha=args.alpha, lamb=args.lamb, trigger = trigger, state_dtype=getattr(torch, args.state_dtype), skip=filter_skip)
                     elif args.filter == "smoother":
-                        grads = smoother(model, grads=grads, beta=args.beta, pp=args.pp)
+                        grads = smoother(model, grads=grads, beta=args.beta, pp=args.pp, skip=filter_skip)
                     elif args.filter == "kalman":
                         grads = gradfilter_kalman(
                             model,
@@ -197,6 +248,8 @@ def main(args):
                             process_noise=args.process_noise,
                             measurement_noise=args.measurement_noise,
                             lamb=args.lamb,
+                            state_dtype=getattr(torch, args.state_dtype),
+                            skip=filter_skip,
                         )
                     else:
                         raise ValueError(f"Invalid gradient filter type `{args.filter}`")
@@ -207,9 +260,10 @@ def main(args):
                     scheduler.step()
                     i += 1
 
-                acc = (logits[-1].argmax(-1) == input[-1]).float().mean()
-                total_acc += acc.item() * input.shape[-1]
+                total_acc += (logits[-1].argmax(-1) == input[-1]).float().sum()
 
+            total_loss = total_loss.item()
+            total_acc = total_acc.item()
             if is_train:
                 train_acc.append(total_acc / train_data.shape[-1])
                 train_loss.append(total_loss / train_data.shape[-1])
@@ -219,12 +273,16 @@ def main(args):
                 val_loss.append(total_loss / valid_data.shape[-1])
 
         with torch.no_grad():
-            param_vector = torch.cat([p.view(-1) for p in model.parameters()])
-            # init_vector = torch.cat([p.view(-1) for p in initial_state.values()])
-            l2_norm = torch.norm(param_vector, p=2).item()
-            l2_distance = torch.norm(param_vector - init_vector, p=2).item()
-            l1_norm = torch.norm(param_vector, p=1).item()
-            l1_distance = torch.norm(param_vector - init_vector, p=1).item()
+            # Per-tensor norms reduced on the device, instead of concatenating
+            # the whole model into a flat vector every epoch.
+            diffs = torch._foreach_sub(params, init_params)
+            l2_norm, l2_distance, l1_norm, l1_distance = torch.stack([
+                torch.linalg.vector_norm(torch.stack(torch._foreach_norm(params, 2))),
+                torch.linalg.vector_norm(torch.stack(torch._foreach_norm(diffs, 2))),
+                torch.stack(torch._foreach_norm(params, 1)).sum(),
+                torch.stack(torch._foreach_norm(diffs, 1)).sum(),
+            ]).tolist()
+            del diffs
 
             param_norms_l2.append(l2_norm)
             param_distances_l2.append(l2_distance)
@@ -238,27 +296,13 @@ def main(args):
             do_save = (e + 1) % 100 == 0
         if do_save:
             steps = torch.arange(len(train_acc)).numpy() * steps_per_epoch
-            plt.plot(steps, train_acc, label="train")
-            plt.plot(steps, val_acc, label="val")
-            plt.legend()
-            plt.title("Modular Multiplication (training on 50% of data)")
-            plt.xlabel("Optimization Steps")
-            plt.ylabel("Accuracy")
-            plt.xscale("log", base=10)
-            plt.grid()
-            plt.savefig(f"results_old/acc_{args.label}.png", dpi=150)
-            plt.close()
-
-            plt.plot(steps, train_loss, label="train")
-            plt.plot(steps, val_loss, label="val")
-            plt.legend()
-            plt.title("Modular Multiplication (training on 50% of data)")
-            plt.xlabel("Optimization Steps")
-            plt.ylabel("Loss")
-            plt.xscale("log", base=10)
-            plt.grid()
-            plt.savefig(f"results_old/loss_{args.label}.png", dpi=150)
-            plt.close()
+            # re-raise any error from the previous plots before queueing new ones
+            for future in plot_futures:
+                future.result()
+            plot_futures = [
+                plot_executor.submit(plot_train_val, plot_figure, steps, train_acc[:], val_acc[:], "Accuracy", f"results_old/acc_{args.label}.png"),
+                plot_executor.submit(plot_train_val, plot_figure, steps, train_loss[:], val_loss[:], "Loss", f"results_old/loss_{args.label}.png"),
+            ]
             """
             plt.plot(steps, sparsity_log, label="sparsity")
             plt.legend()
@@ -273,7 +317,11 @@ def main(args):
 
             if args.save_weights:
                 net_its.append(e)
-                nets.append(copy.deepcopy(model.state_dict()))           
+                nets.append(snapshot_state_dict(model, snapshot_buffer))
+
+    plot_executor.shutdown(wait=True)
+    for future in plot_futures:
+        future.result()
 
     steps = torch.arange(len(param_norms_l1)).numpy() * steps_per_epoch
     results = {
@@ -297,32 +345,10 @@ def main(args):
     # results['steps'] = steps
     # torch.save(results, f"results/res_{args.label}.pt")
     # Plotting L2 norms and distances
-    plt.figure()
-    plt.plot(steps, param_norms_l2, label="L2 Norm")
-    plt.plot(steps, param_distances_l2, label="L2 Distance from Initial")
-    plt.xlabel("Optimization Steps")
-    plt.ylabel("L2 Norm")
-    plt.xscale("log", base=10)
-    plt.yscale("log", base=10)
-    plt.legend()
-    plt.title("L2 Norm and Distance")
-    plt.legend()
-    plt.savefig(f"results_old/norms_distances_l2_{args.label}.png")
-    plt.close()
+    plot_norm_distance(plot_figure, steps, param_norms_l2, param_distances_l2, "L2", f"results_old/norms_distances_l2_{args.label}.png")
 
     # Plotting L1 norms and distances
-    plt.figure()
-    plt.plot(steps, param_norms_l1, label="L1 Norm")
-    plt.plot(steps, param_distances_l1, label="L1 Distance from Initial")
-    plt.xlabel("Optimization Steps")
-    plt.ylabel("L1 Norm")
-    plt.xscale("log", base=10)
-    plt.yscale("log", base=10)
-    plt.legend()
-    plt.title("L1 Norm and Distance")
-    plt.legend()
-    plt.savefig(f"results_old/norms_distances_l1_{args.label}.png")
-    plt.close()
+    plot_norm_distance(plot_figure, steps, param_norms_l1, param_distances_l1, "L1", f"results_old/norms_distances_l1_{args.label}.png")
         
 
 
@@ -347,6 +373,8 @@ if __name__ == "__main__":
     parser.add_argument("--lamb", type=float, default=5.0)
     parser.add_argument("--process_noise", type=float, default=1e-4)
     parser.add_argument("--measurement_noise", type=float, default=1e-2)
+    parser.add_argument("--state_dtype", type=str, choices=["float32", "bfloat16", "float16"], default="float32")
+    parser.add_argument("--filter_skip", type=str, nargs="*", default=[]) # e.g. token_embeddings.weight position_embeddings.weight
 
     # Smoother
     parser.add_argument("--beta", type=float, default=0.98)
@@ -1,113 +1,252 @@
-from collections import deque
-from typing import Dict, Optional, Literal
+from typing import Any, Dict, List, Optional, Literal, Set, Tuple
+from weakref import WeakKeyDictionary
 import torch
 import torch.nn as nn
 
 
+# The parameter set of a model is fixed over a run, so the module tree is only
+# walked once per model. `requires_grad` and `grad` may still change between
+# calls (e.g. the LoRA switch), so they are checked on every call. Weak keys
+# let the entry go with the model, so a new model never hits a stale entry.
+_PARAM_CACHE: "WeakKeyDictionary[nn.Module, List[Tuple[str, nn.Parameter]]]" = WeakKeyDictionary()
+
+
+def _params_with_grad(
+    m: nn.Module,
+    skip: Optional[Set[str]] = None,
+) -> Tuple[List[str], List[nn.Parameter]]:
+    named_params = _PARAM_CACHE.get(m)
+    if named_params is None:
+        named_params = list(m.named_parameters())
+        _PARAM_CACHE[m] = named_params
+
+    names, params = [], []
+    for n, p in named_params:
+        if p.requires_grad and p.grad is not None and not (skip and n in skip):
+            names.append(n)
+            params.append(p)
+    return names, params
+
+
+def _flat_copy(
+    tensors: List[torch.Tensor],
+    dtype: Optional[torch.dtype] = None,
+) -> List[torch.Tensor]:
+    # Copy `tensors` into one contiguous buffer and return views of it shaped
+    # like the inputs, so a filter state is a single allocation laid out in
+    # parameter order instead of one small allocation per parameter.
+    if not tensors:
+        return []
+    flat = torch.cat([t.reshape(-1).to(dtype or t.dtype) for t in tensors])
+    return [v.view_as(t) for v, t in zip(flat.split([t.numel() for t in tensors]), tensors)]
+
+
+@torch.no_grad()
 def gradfilter_ma(
     m: nn.Module,
-    grads: Optional[Dict[str, deque]] = None,
+    grads: Optional[Dict[str, Dict[str, Any]]] = None,
     window_size: int = 100,
     lamb: float = 5.0,
     filter_type: Literal['mean', 'sum'] = 'mean',
     warmup: bool = True,
     trigger: bool = False, # For ablation study.
-) -> Dict[str, deque]:
+    skip: Optional[Set[str]] = None, # Names of parameters left unfiltered.
+) -> Dict[str, Dict[str, Any]]:
+    names, params = _params_with_grad(m, skip)
     if grads is None:
-        grads = {n: deque(maxlen=window_size) for n, p in m.named_parameters() if p.requires_grad and p.grad is not None}
-
-    for n, p in m.named_parameters():
-        if p.requires_grad and p.grad is not None:
-            grads[n].append(p.grad.data.detach()) # .cpu())
-
-            # Modify the gradients.
-            if not warmup or len(grads[n]) == window_size and not trigger:
-                if filter_type == "mean":
-                    avg = sum(grads[n]) / len(grads[n])
-                elif filter_type == "sum":
-                    avg = sum(grads[n])
-                else:
-                    raise ValueError(f"Unrecognized filter_type {filter_type}")
-                p.grad.data = p.grad.data + avg * lamb
+        # A ring buffer of the last `window_size` gradients and their running sum,
+        # so each step costs O(1) tensor ops per parameter instead of O(window_size).
+        sums = _flat_copy([torch.zeros_like(p.grad) for p in params])
+        grads = {
+            n: {
+                "buf": torch.zeros((window_size, *p.grad.shape), dtype=p.grad.dtype, device=p.grad.device),
+                "sum": sum_,
+                "idx": 0,
+                "count": 0,
+            }
+            for n, p, sum_ in zip(names, params, sums)
+        }
+
+    if not names:
+        return grads
+
+    states = [grads[n] for n in names]
+    ps = [p.grad for p in params]
+    slots = [s["buf"][s["idx"]] for s in states]
+    sums = [s["sum"] for s in states]
+
+    # Evict the oldest gradient (zeros until the buffer is full) and add the new one.
+    torch._foreach_sub_(sums, slots)
+    torch._foreach_copy_(slots, ps)
+    torch._foreach_add_(sums, ps)
+    for s in states:
+        s["idx"] = (s["idx"] + 1) % window_size
+        s["count"] = min(s["count"] + 1, window_size)
+        if s["idx"] == 0:
+            # Resync once per window so rounding errors don't accumulate.
+            torch.sum(s["buf"], dim=0, out=s["sum"])
+
+    # Modify the gradients. The scale is folded into the add, so the average is
+    # never materialized; parameters are grouped by how full their window is.
+    apply = [i for i, s in enumerate(states) if not warmup or s["count"] == window_size and not trigger]
+    for count in sorted({states[i]["count"] for i in apply}):
+        group = [i for i in apply if states[i]["count"] == count]
+        if filter_type == "mean":
+            scale = lamb / count
+        elif filter_type == "sum":
+            scale = lamb
+        else:
+            raise ValueError(f"Unrecognized filter_type {filter_type}")
+        torch._foreach_add_([ps[i] for i in group], [sums[i] for i in group], alpha=scale)
 
     return grads
 
 
+@torch.no_grad()
 def gradfilter_ema(
     m: nn.Module,
     grads: Optional[Dict[str, torch.Tensor]] = None,
     alpha: float = 0.98,
     lamb: float = 2.0,
-    trigger: bool = False
+    trigger: bool = False,
+    state_dtype: Optional[torch.dtype] = None, # e.g. torch.bfloat16; None keeps the gradient dtype.
+    skip: Optional[Set[str]] = None, # Names of parameters left unfiltered.
 ) -> Dict[str, torch.Tensor]:
+    names, params = _params_with_grad(m, skip)
     if grads is None:
-        grads = {n: p.grad.data.detach() for n, p in m.named_parameters() if p.requires_grad and p.grad is not None}
-
-    for n, p in m.named_parameters():
-        if p.requires_grad and p.grad is not None:
-            if not trigger:
-                grads[n] = grads[n] * alpha + p.grad.data.detach() * (1 - alpha)
-                p.grad.data = (p.grad.data + grads[n] * lamb) / (1 + lamb)
+        # Copy since the state is updated in place below.
+        grads = dict(zip(names, _flat_copy([p.grad for p in params], state_dtype)))
+
+    if trigger or not names:
+        return grads
+
+    # One fused kernel per op over all parameters instead of one per tensor.
+    gs = [grads[n] for n in names]
+    ps = [p.grad for p in params]
+    # Low-precision state is up-cast for the arithmetic and rounded once on
+    # write-back; `.to` returns the state itself when the dtypes already match.
+    avgs = [g.to(p.dtype) for g, p in zip(gs, ps)]
+    torch._foreach_mul_(avgs, alpha)
+    torch._foreach_add_(avgs, ps, alpha=1 - alpha)
+    # (g + lamb * avg) / (1 + lamb) as a single read-modify-write of the gradients.
+    torch._foreach_lerp_(ps, avgs, lamb / (1 + lamb))
+    rounded = [i for i, (g, avg) in enumerate(zip(gs, avgs)) if g is not avg]
+    if rounded:
+        torch._foreach_copy_([gs[i] for i in rounded], [avgs[i] for i in rounded])
 
     return grads
 
+@torch.no_grad()
 def smoother(
     m: nn.Module,
     grads: Optional[Dict[str, torch.Tensor]] = None,
     beta: float = 0.98,
     pp: float = 0.01,
+    skip: Optional[Set[str]] = None, # Names of parameters left unfiltered.
 ) -> Dict[str, torch.Tensor]:
-    # Initialize grads if not provided
+    names, params = _params_with_grad(m, skip)
+
+    # The state is the smoothed parameters z, initialized with the parameters
+    # themselves and persisted across calls.
     if grads is None:
-        grads = {n: p.grad.data.detach() for n, p in m.named_parameters() if p.requires_grad and p.grad is not None}
-    
-    # Initialize z with the same parameters as grads
-    z = {n: p.data.clone() for n, p in m.named_parameters() if p.requires_grad and p.grad is not None}
-    
+        grads = dict(zip(names, _flat_copy(params)))
+
+    if not names:
+        return grads
+
+    # Parameters that only start getting gradients mid-run (e.g. after the
+    # LoRA switch) start from their current values.
+    for n, p in zip(names, params):
+        if n not in grads:
+            grads[n] = p.detach().clone()
+
+    zs = [grads[n] for n in names]
+    gs = [p.grad for p in params]
+
     # Update gradients based on the smoother algorithm
-    for n, p in m.named_parameters():
-        if p.requires_grad and p.grad is not None:
-            z[n] = z[n] + beta * (p.data - z[n])
-            p.grad.data -= pp * (p.data - z[n])
-    
+    # z = z + beta * (p - z)
+    torch._foreach_lerp_(zs, params, beta)
+    # grad = grad - pp * (p - z)
+    torch._foreach_add_(gs, torch._foreach_sub(params, zs), alpha=-pp)
+
     return grads
 
+
+def _kalman_step(
+    g: torch.Tensor,
+    x: torch.Tensor,
+    P: torch.Tensor,
+    process_noise: float,
+    measurement_noise: float,
+    lamb: float,
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    # Scripted (see _scripted_kalman_step) so the elementwise ops below fuse
+    # into a single kernel that reads and writes {g, x, P} once, instead of
+    # one kernel per op. The state {x, P} may be stored in a lower precision;
+    # it is up-cast and rounded back inside the fused kernel.
+    state_dtype = x.dtype
+    x = x.to(g.dtype)
+    P = P.to(g.dtype)
+
+    # Prediction step
+    P_pred = P + process_noise
+
+    # Update step
+    S = P_pred + measurement_noise
+    K = P_pred / S
+    x = x + K * (g - x)
+    P = (1 - K) * P_pred
+
+    # Apply the filtered gradient
+    g = g + x * lamb
+    return g, x.to(state_dtype), P.to(state_dtype)
+
+
+_KALMAN_STEP = None
+
+
+def _scripted_kalman_step():
+    # Scripted on first use rather than at import, so importing this module
+    # doesn't trigger TorchScript (deprecated on recent torch) for runs that
+    # never use the Kalman filter.
+    global _KALMAN_STEP
+    if _KALMAN_STEP is None:
+        _KALMAN_STEP = torch.jit.script(_kalman_step)
+    return _KALMAN_STEP
+
+
+@torch.no_grad()
 def gradfilter_kalman(
     m: nn.Module,
     grads: Optional[Dict[str, Dict[str, torch.Tensor]]] = None,
     process_noise: float = 1e-4,
     measurement_noise: float = 1e-2,
     lamb: float = 2.0,
+    state_dtype: Optional[torch.dtype] = None, # e.g. torch.bfloat16; None keeps the gradient dtype.
+    skip: Optional[Set[str]] = None, # Names of parameters left unfiltered.
 ) -> Dict[str, Dict[str, torch.Tensor]]:
+    names, params = _params_with_grad(m, skip)
     if grads is None:
         grads = {
             n: {
-                "x": torch.zeros_like(p.grad.data),
-                "P": torch.ones_like(p.grad.data) * measurement_noise,
+                "x": torch.zeros_like(p.grad, dtype=state_dtype),
+                "P": torch.full_like(p.grad, measurement_noise, dtype=state_dtype),
             }
-            for n, p in m.named_parameters()
-            if p.requires_grad and p.grad is not None
+            for n, p in zip(names, params)
         }
 
-    for n, p in m.named_parameters():
-        if p.requires_grad and p.grad is not None:
-            # Prediction step
-            x_pred = grads[n]["x"]
-            P_pred = grads[n]["P"] + process_noise
-
-            # Update step
-            y = p.grad.data - x_pred
-            S = P_pred + measurement_noise
-            K = P_pred / S
-            x = x_pred + K * y
-            P = (1 - K) * P_pred
-
-            # Store updated state
-            grads[n]["x"] = x
-            grads[n]["P"] = P
-
-            # Apply the filtered gradient
-            p.grad.data += x * lamb
+    kalman_step = _scripted_kalman_step()
+    for n, p in zip(names, params):
+        state = grads[n]
+        g, state["x"], state["P"] = kalman_step(
+            p.grad,
+            state["x"],
+            state["P"],
+            process_noise,
+            measurement_noise,
+            lamb,
+        )
+        p.grad = g
 
     return grads
 
@@ -138,7 +138,7 @@ for epoch in range(num_epochs):
             grads = gradfilter_ma(model, grads=grads, window_size=args.window_size, lamb=args.lamb)
         elif args.filter == "ema":
             if epoch == switch_epoch:
-                grads = {n: p.grad.data.detach() for n, p in model.named_parameters() if p.requires_grad and p.grad is not None}
+                grads = {n: p.grad.data.detach().clone() for n, p in model.named_parameters() if p.requires_grad and p.grad is not None}
             grads = gradfilter_ema(model, grads=grads, alpha=args.alpha, lamb=args.lamb)
             """
             if i < args.cutoff_steps:
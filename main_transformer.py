@@ -1,10 +1,13 @@
 import math
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 from itertools import permutations
-import copy
 import numpy as np
 
+import matplotlib
+matplotlib.use("Agg") # non-interactive, files only
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 from tqdm import tqdm
 import seaborn as sns
 
@@ -24,6 +27,13 @@ def main(args):
 
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     _ = torch.randn(1, device=device)
+    # Input shapes are fixed, so let cuDNN autotune once.
+    torch.backends.cudnn.benchmark = True
+    if args.tf32:
+        # TF32 tensor cores for float32 matmuls and convolutions on Ampere and newer GPUs.
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+        torch.set_float32_matmul_precision("high")
     update_rank_percentage = args.update_rank_percentage
 
     # tokens for <op> and <=>. It's not clear why <=> is needed at all since it
@@ -42,19 +52,40 @@ def main(args):
     print(model)
     print(f'Total number of parameters: {nparams}')
 
+    # Each step of this tiny model is bound by kernel launches, so compile the
+    # transformer blocks to fuse their ops and replay them with CUDA graphs.
+    # Only the blocks are compiled (in place, so parameter names are unchanged);
+    # Decoder.forward, with its attention-map bookkeeping, stays eager, and so
+    # do the rare steps that log attention maps (see the training loop).
+    # The blocks share one forward, which is specialized per block (their
+    # requires_grad differ), per grad mode and per batch shape (full and last
+    # partial batch of the train and valid splits); allow for all of them.
+    torch._dynamo.config.recompile_limit = max(torch._dynamo.config.recompile_limit, 16)
+    for block in model.layers:
+        block.compile(mode="reduce-overhead", dynamic=False)
+
     data = multiplication_mod_p_data(args.p, eq_token, op_token)
 
     train_idx, valid_idx = torch.randperm(data.shape[1]).split(data.shape[1] // 2)
     train_data, valid_data = data[:, train_idx], data[:, valid_idx]
+    # The dataset is tiny and fixed, so keep it on the device and batch from there.
+    train_data, valid_data = train_data.to(device), valid_data.to(device)
 
     # For most experiments we used AdamW optimizer with learning rate 10−3,
     # weight decay 1, β1 = 0.9, β2 = 0.98
 
+    # Batch the per-parameter update kernels: the fused Adam(W) kernel on CUDA,
+    # the multi-tensor (foreach) implementation everywhere else.
+    if device.type == "cuda" and args.optimizer in ("Adam", "AdamW"):
+        optimizer_kwargs = {"fused": True}
+    else:
+        optimizer_kwargs = {"foreach": True}
     torch_optimizer = getattr(torch.optim, args.optimizer)(
         model.parameters(),
         lr=args.lr,
         weight_decay=args.weight_decay,
         betas=(args.beta1, args.beta2),
+        **optimizer_kwargs,
     )
 
     """
@@ -73,6 +104,10 @@ def main(args):
     # the layer to plot the normalized effective ranks
     layer_inspected = 2
     layer = model.layers[layer_inspected - 1] 
+    # the ranks take an SVD per matrix, so they are only computed every
+    # rank_interval epochs and at the epochs that are plotted
+    rank_interval = 10
+    rank_steps = []
 
     layer_weights = extract_weight_matrices(layer)
     layer_matrix_ranks = {}
@@ -86,12 +121,17 @@ def main(args):
 
     its, train_acc, val_acc, train_loss, val_loss = [], [], [], [], []
     grads = None
+    filter_skip = set(args.filter_skip)
     i = 0
     # set the interval for logging cosine similarity 
     cos_sim_interval = [10]
 
-    # For logging network weights.
+    # For logging network weights. Snapshots are staged in one flat (pinned on
+    # CUDA) buffer, so each is a single device-to-host transfer and one clone.
     net_its, nets = [], []
+    snapshot_buffer = torch.empty(
+        sum(t.numel() for t in model.state_dict().values()), pin_memory=device.type == "cuda"
+    )
 
     count = 0
     grads_similarity_log = [None for _ in range(len(cos_sim_interval))]
@@ -102,33 +142,51 @@ def main(args):
         count = count + 1
 
     
-    save_epochs_for_attention_maps = [0, 1, 10, 100, 1000, 10000, 50000, (int(args.budget) // steps_per_epoch - 1) * steps_per_epoch]
+    save_epochs_for_attention_maps = frozenset([0, 1, 10, 100, 1000, 10000, 50000, (int(args.budget) // steps_per_epoch - 1) * steps_per_epoch])
     save_filenames_layer1 = []
     save_filenames_layer2 = []
 
+    # Reused by the per-epoch shuffle instead of allocating a new permutation.
+    perm = torch.empty(train_data.shape[1], dtype=torch.long, device=device)
+
+    # Plots are rendered on a background thread so training doesn't wait on them.
+    # A single worker renders them one at a time, so they can share one Figure.
+    plot_executor = ThreadPoolExecutor(max_workers=1)
+    plot_futures = []
+    plot_figure = Figure()
+
     for e in tqdm(range(int(args.budget) // steps_per_epoch)):
 
-        # randomly shuffle train data
-        train_data = train_data[:, torch.randperm(train_data.shape[1])]
+        # randomly shuffle train data; train_data itself is left untouched
+        torch.randperm(train_data.shape[1], out=perm)
+        train_view = train_data.index_select(1, perm)
 
-        for data, is_train in [(train_data, True), (valid_data, False)]:
+        save_attn_this_epoch = e * steps_per_epoch in save_epochs_for_attention_maps
+
+        for data, is_train in [(train_view, True), (valid_data, False)]:
 
             model.train(is_train)
-            total_loss = 0
-            total_acc = 0
+            # Accumulate on the device; syncing with .item() every batch stalls the stream.
+            total_loss = torch.zeros((), device=device)
+            total_acc = torch.zeros((), device=device)
             total_jacobian_norm_change = 0
 
-            # torch.split faster than dataloader with tensor
-            dl = torch.split(data, args.batch_size, dim=1)
-            for input in dl:
-                input = input.to(device)
+            # slicing views is faster than dataloader with tensor
+            for start in range(0, data.shape[1], args.batch_size):
+                input = data[:, start:start + args.batch_size]
 
-                with torch.set_grad_enabled(is_train):
-                    need_attn_weights = False
-                    if e * steps_per_epoch in save_epochs_for_attention_maps and i % steps_per_epoch == 0:
-                        need_attn_weights = True
+                # With --bf16 the forward pass and loss run under bfloat16 autocast;
+                # parameters, gradients and optimizer state stay in float32.
+                with torch.set_grad_enabled(is_train), torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=args.bf16):
+                    need_attn_weights = save_attn_this_epoch and i % steps_per_epoch == 0
 
-                    logits, attention_maps = model(input[:-1], need_attn_weights)
+                    if need_attn_weights:
+                        # a different branch in Block.forward; run it eagerly
+                        # rather than compiling a variant used a handful of times
+                        with torch.compiler.set_stance("force_eager"):
+                            logits, attention_maps = model(input[:-1], need_attn_weights)
+                    else:
+                        logits, attention_maps = model(input[:-1], need_attn_weights)
 
                     if need_attn_weights:
                         filenames = plot_attention_maps(attention_maps, e * steps_per_epoch)
@@ -137,11 +195,16 @@ def main(args):
                         if filenames[1] not in save_filenames_layer2:
                             save_filenames_layer2.append(filenames[1])
                     # calculate loss only on the answer part of the equation (last element
-                    loss = F.cross_entropy(logits[-1], input[-1])
-                    total_loss += loss.item() * input.shape[-1]
+                    if is_train:
+                        loss = F.cross_entropy(logits[-1], input[-1])
+                        total_loss += loss.detach() * input.shape[-1]
+                    else:
+                        # only the summed loss is needed for logging
+                        logp = F.log_softmax(logits[-1], dim=-1)
+                        total_loss -= logp.gather(-1, input[-1].unsqueeze(-1)).sum()
 
                 if is_train:
-                    model.zero_grad()
+                    model.zero_grad(set_to_none=True)
                     loss.backward()
                     """
                     if i == 1:
@@ -157,25 +220,30 @@ def main(args):
                     if args.filter == "none":
                         pass
                     elif args.filter == "ma":
-                        grads = gradfilter_ma(model, grads=grads, window_size=args.window_size, lamb=args.lamb, trigger=trigger)
+                        grads = gradfilter_ma(model, grads=grads, window_size=args.window_size, lamb=args.lamb, trigger=trigger, skip=filter_skip)
                     elif args.filter == "ema":
-                        grads = gradfilter_ema(model, grads=grads, alpha=args.alpha, lamb=args.lamb, trigger=trigger)
+                        grads = gradfilter_ema(model, grads=grads, alpha=args.alpha, lamb=args.lamb, trigger=trigger, state_dtype=getattr(torch, args.state_dtype), skip=filter_skip)
                     elif args.filter == "smoother":
-                        grads = smoother(model, grads=grads, beta=args.beta, pp=args.pp)
+                        grads = smoother(model, grads=grads, beta=args.beta, pp=args.pp, skip=filter_skip)
                     elif args.filter == "kalman":
-                        grads = gradfilter_kalman(model, grads=grads, process_noise=args.process_noise, measurement_noise=args.measurement_noise, lamb=args.lamb)
+                        grads = gradfilter_kalman(model, grads=grads, process_noise=args.process_noise, measurement_noise=args.measurement_noise, lamb=args.lamb, state_dtype=getattr(torch, args.state_dtype), skip=filter_skip)
                     else:
                         raise ValueError(f"Invalid update filter type `{args.filter}`")
                     
                     # perform low-rank projection on grads
                     if args.enable_lr_update:
                         with torch.no_grad():
+                            # Bucket the 2D grads by shape and project each bucket with one batched SVD.
+                            buckets = {}
                             for name, param in model.named_parameters():
                                 if param.grad is not None and len(param.grad.shape) == 2:
-                                    grad = param.grad
-                                    max_rank = max(grad.shape)
-                                    rank = int(update_rank_percentage * max_rank)
-                                    param.grad = low_rank_approximation(grad, rank)
+                                    buckets.setdefault(param.grad.shape, []).append(param)
+                            for shape, bucket in buckets.items():
+                                max_rank = max(shape)
+                                rank = int(update_rank_percentage * max_rank)
+                                low_rank_grads = batched_low_rank_approximation(torch.stack([param.grad for param in bucket]), rank, randomized=args.randomized_svd)
+                                for param, grad in zip(bucket, low_rank_grads):
+                                    param.grad = grad
 
 
                     # Update gradients using AdamW
@@ -203,10 +271,11 @@ def main(args):
                     # Zero gradients after update
                     i += 1
 
-                acc = (logits[-1].argmax(-1) == input[-1]).float().mean()
-                total_acc += acc.item() * input.shape[-1]
+                total_acc += (logits[-1].argmax(-1) == input[-1]).float().sum()
                 
 
+            total_loss = total_loss.item()
+            total_acc = total_acc.item()
             if is_train:
                 train_acc.append(total_acc / train_data.shape[-1])
                 train_loss.append(total_loss / train_data.shape[-1])
@@ -235,43 +304,40 @@ def main(args):
         """
         
 
-        layer_weights = extract_weight_matrices(layer)
-        for name, weight_matrix in layer_weights.items():
-            layer_matrix_ranks[name].append(compute_norm_effective_rank(weight_matrix))
-            layer_matrix_entropy[name].append(compute_norm_shannon_entropy(weight_matrix))
-        
-
         if args.save_weights:
             do_save = e <= 100 or (e > 100 and (e + 1) % 100 == 0) or e == int(args.budget) // steps_per_epoch - 1
         else:
             do_save = (e + 10) % 100 == 0
+
+        if do_save or e % rank_interval == 0:
+            rank_steps.append(e * steps_per_epoch)
+            # re-resolved at each metric point: with LoRA the MLP weights are
+            # plain tensors that LoRALinear.forward rebuilds on every call
+            layer_weights = extract_weight_matrices(layer)
+            for name, weight_matrix in layer_weights.items():
+                weight_matrix = weight_matrix.detach()
+                layer_matrix_ranks[name].append(compute_norm_effective_rank(weight_matrix))
+                layer_matrix_entropy[name].append(compute_norm_shannon_entropy(weight_matrix))
+
         if do_save:
             print(f"epoch {e}: training acc: {train_acc[-1]}\n")
             print(f"epoch {e}: test acc: {val_acc[-1]}\n")
             steps = torch.arange(len(train_acc)).numpy() * steps_per_epoch
-            
-            plt.plot(steps, train_acc, label="train")
-            plt.plot(steps, val_acc, label="val")
-            plt.legend()
-            plt.title("Modular Multiplication (training on 50% of data)")
-            plt.xlabel("Optimization Steps")
-            plt.ylabel("Accuracy")
-            plt.xscale("log", base=10)
-            plt.grid()
-            plt.savefig(f"results_transformer/acc_{args.label}.png", dpi=150)
-            plt.close()
-            
-
-            plt.plot(steps, train_loss, label="train")
-            plt.plot(steps, val_loss, label="val")
-            plt.legend()
-            plt.title("Modular Multiplication (training on 50% of data)")
-            plt.xlabel("Optimization Steps")
-            plt.ylabel("Loss")
-            plt.xscale("log", base=10)
-            plt.grid()
-            plt.savefig(f"results_transformer/loss_{args.label}.png", dpi=150)
-            plt.close()
+            # re-raise any error from the previous plots before queueing new ones
+            for future in plot_futures:
+                future.result()
+            plot_futures = [
+                plot_executor.submit(plot_train_val, plot_figure, steps, train_acc[:], val_acc[:], "Accuracy", f"results_transformer/acc_{args.label}.png"),
+                plot_executor.submit(plot_train_val, plot_figure, steps, train_loss[:], val_loss[:], "Loss", f"results_transformer/loss_{args.label}.png"),
+                plot_executor.submit(
+                    plot_layer_ranks,
+                    plot_figure,
+                    rank_steps[:],
+                    {name: value[:] for name, value in layer_matrix_ranks.items()},
+                    layer_inspected,
+                    f"results_transformer/layer_{layer_inspected}_ranks_{args.label}.png",
+                ),
+            ]
 
             # plot grads changes
             """
@@ -288,21 +354,10 @@ def main(args):
                 count = count + 1
             """
 
-            
-            for name, value in layer_matrix_ranks.items():
-                plt.plot(steps, value, label=f"matrix_{name}")
-            plt.legend()
-            plt.title(f"normalized effective ranks on layer_{layer_inspected}")
-            plt.xlabel("Optimization Steps")
-            plt.ylabel("normalized ranks")
-            plt.xscale("log", base=10)
-            plt.grid()
-            plt.savefig(f"results_transformer/layer_{layer_inspected}_ranks_{args.label}.png", dpi=150)
-            plt.close()
 
             """
             for name, value in layer_matrix_entropy.items():
-                plt.plot(steps, value, label=f"matrix_{name}")
+                plt.plot(rank_steps, value, label=f"matrix_{name}")
             plt.legend()
             plt.title(f"Shannon entropy of layer_{layer_inspected}")
             plt.xlabel("Optimization Steps")
@@ -316,7 +371,11 @@ def main(args):
 
             if args.save_weights:
                 net_its.append(e)
-                nets.append(copy.deepcopy(model.state_dict()))           
+                nets.append(snapshot_state_dict(model, snapshot_buffer))
+
+    plot_executor.shutdown(wait=True)
+    for future in plot_futures:
+        future.result()
 
     concatenate_images(save_filenames_layer1, f'results_transformer/attention_maps_layer1_{args.label}.png')
     concatenate_images(save_filenames_layer2, f'results_transformer/attention_maps_layer2_{args.label}.png')  
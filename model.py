@@ -93,11 +93,9 @@ class Block(nn.Module):
 
 
     def forward(self, x, need_attn_weights = False):
-        attn_mask = torch.full(
-            (len(x), len(x)), -float("Inf"), device=x.device, dtype=x.dtype
-        )
-        attn_mask = torch.triu(attn_mask, diagonal=1)
-        attn_mask[torch.isnan(attn_mask)] = 0.0 # fixes all 'nan' on 'mps' device
+        # boolean causal mask (True = not allowed to attend); unlike triu on an
+        # -inf float mask this needs no 'nan' clean-up on 'mps' devices
+        attn_mask = torch.ones((len(x), len(x)), dtype=torch.bool, device=x.device).triu_(1)
         attention_matrices = 0
 
         x = self.ln_1(x)
@@ -196,13 +194,13 @@ class Decoder(nn.Module):
 def multiplication_mod_p_data(p, eq_token, op_token):
     """x◦y = x/y (mod p) for 0 ≤ x < p, 0 < y < p
     """
-    x = torch.arange(p)
-    y = torch.arange(1, p)
-    x, y = torch.cartesian_prod(x, y).T
+    x, y = torch.meshgrid(torch.arange(p), torch.arange(1, p), indexing='ij')
+    x = x.reshape(-1)
+    y = y.reshape(-1)
 
-    eq = torch.ones_like(x) * eq_token
-    op = torch.ones_like(x) * op_token
-    result = (x**2 + x * y + y**2) % p
+    eq = torch.full_like(x, eq_token)
+    op = torch.full_like(x, op_token)
+    result = (x * x).add_(x * y).add_(y * y).remainder_(p)
 
     # "All of our experiments used a small transformer trained on datasets of
     # equations of the form a◦b = c, where each of “a”, “◦”, “b”, “=”, and “c”
@@ -1,4 +1,12 @@
-import subprocess
+import multiprocessing
+import queue
+import runpy
+import sys
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+import torch
 
 # In this config: we grid search post_grokfast
 # on lamb
@@ -45,9 +53,17 @@ configs1 = [
 },
 ]
 
-# Function to run the main program with specified arguments
+# Number of configs run at the same time on each GPU. The model is small, so
+# one run leaves most of a GPU idle; raise this to share a GPU between runs
+# (best under NVIDIA MPS).
+runs_per_gpu = 1
+
+# Function to run the main program with specified arguments.
+# main_mlp_LoRA.py is a script, so it is executed in this process with its
+# command line patched in; the interpreter, imports and CUDA context are
+# then set up once for all configs instead of once per config.
 def run_experiment_in_main_mlp_LoRA(config):
-    cmd = ["python", "main_mlp_LoRA.py"]
+    cmd = ["main_mlp_LoRA.py"]
     for key, value in config.items():
         if isinstance(value, bool):
             if value:  # Only add the flag if it's set to True
@@ -55,11 +71,88 @@ def run_experiment_in_main_mlp_LoRA(config):
         else:
             cmd.append(f"--{key}")
             cmd.append(str(value))
-    print("Running command:", " ".join(cmd))
-    subprocess.run(cmd)
+    print("Running command:", " ".join(["python"] + cmd))
+    argv = sys.argv
+    sys.argv = cmd
+    try:
+        runpy.run_path("main_mlp_LoRA.py", run_name="__main__")
+    except (Exception, SystemExit):
+        # a failing config (including OOM or a bad flag) is reported and the
+        # grid moves on, as it did when each config ran in its own process
+        print(f"Config {config} failed:", file=sys.stderr)
+        traceback.print_exc()
+    finally:
+        sys.argv = argv
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
 
 
-# Run experiments with different configurations
-for config in configs1:
-    run_experiment_in_main_mlp_LoRA(config)
+config_events = None
+
+
+def init_worker(gpu_ids, events):
+    # Each worker process takes one GPU slot; "cuda" then refers to that GPU.
+    global config_events
+    torch.cuda.set_device(gpu_ids.get())
+    config_events = events
 
+
+def run_experiment_in_worker(index):
+    # Record when a config starts and finishes. If the pool breaks, the
+    # configs that had finished are not run again, and only the ones that
+    # were running are charged an attempt.
+    config_events.put((index, "started"))
+    run_experiment_in_main_mlp_LoRA(configs1[index])
+    config_events.put((index, "finished"))
+
+
+# Run experiments with different configurations
+if __name__ == "__main__":
+    num_gpus = torch.cuda.device_count()
+    num_workers = min(num_gpus * runs_per_gpu, len(configs1))
+    if num_workers <= 1:
+        for config in configs1:
+            run_experiment_in_main_mlp_LoRA(config)
+    else:
+        # Spawn (not fork) so CUDA is initialized fresh in each worker.
+        context = multiprocessing.get_context("spawn")
+        # Errors inside a run are handled in run_experiment_in_main_mlp_LoRA. A
+        # worker that dies outright (e.g. killed by the OOM killer) breaks the
+        # whole pool, so the pool is rebuilt and the unfinished configs are
+        # resubmitted; a config that was running when a worker died
+        # max_attempts times is dropped.
+        max_attempts = 3
+        attempts = [0] * len(configs1)
+        pending = list(range(len(configs1)))
+        while pending:
+            gpu_ids = context.Queue()
+            events = context.Queue()
+            for slot in range(num_workers):
+                gpu_ids.put(slot % num_gpus)
+            unfinished = []
+            with ProcessPoolExecutor(num_workers, mp_context=context, initializer=init_worker, initargs=(gpu_ids, events)) as executor:
+                futures = {executor.submit(run_experiment_in_worker, index): index for index in pending}
+                for future in as_completed(futures):
+                    index = futures[future]
+                    try:
+                        future.result()
+                    except BrokenProcessPool:
+                        unfinished.append(index)
+                    except Exception:
+                        print(f"Config {configs1[index]} failed:", file=sys.stderr)
+                        traceback.print_exc()
+            # the events tell which unfinished configs had finished or were running when the pool broke
+            running, finished = set(), set()
+            while unfinished:
+                try:
+                    index, event = events.get(timeout=1)
+                except queue.Empty:
+                    break
+                (finished if event == "finished" else running).add(index)
+            unfinished = [index for index in unfinished if index not in finished]
+            for index in unfinished:
+                if index in running:
+                    attempts[index] += 1
+                    if attempts[index] >= max_attempts:
+                        print(f"Config {configs1[index]} failed: its worker died {attempts[index]} times", file=sys.stderr)
+            pending = [index for index in unfinished if attempts[index] < max_attempts]
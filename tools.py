@@ -20,13 +20,14 @@ from optimizers import *
 from arg_parser import *
 
 
+@torch.no_grad()
 def compute_sparsity(model):
-    total_params = 0
-    zero_params = 0
-    for param in model.parameters():
-        total_params += param.numel()
-        zero_params += (param == 0).sum().item()
-    sparsity = zero_params / total_params
+    params = list(model.parameters())
+    total_params = sum(param.numel() for param in params)
+    # The L0 norm of a tensor is its number of non-zeros; reduce all of them on
+    # the device so there is a single host sync.
+    nonzero_params = torch.stack(torch._foreach_norm(params, 0)).sum().item()
+    sparsity = 1 - nonzero_params / total_params
     return sparsity
 
 def compute_norm_effective_rank(weight_matrix):
@@ -55,9 +56,19 @@ def extract_weight_matrices(layer):
         'ffn2': ffn_weight_2,
     }
 
-def low_rank_approximation(matrix, rank):
+def svd_top(matrix, rank, randomized=False):
+    # Exact SVD by default. With `randomized`, a randomized SVD, O(m * n * rank),
+    # when `rank` is well below min(m, n); it is only close to the exact top-`rank`
+    # truncation when the spectrum decays fast, and it draws from the torch RNG.
+    # Works on a single matrix or a (batch, m, n) stack; returns U, S, V.
+    q = rank + 6
+    if randomized and q <= min(matrix.shape[-2:]):
+        return torch.svd_lowrank(matrix, q=q, niter=2)
+    return torch.svd(matrix)
+
+def low_rank_approximation(matrix, rank, randomized=False):
         # Perform SVD on the attention weights matrix
-        U, S, V = torch.svd(matrix)
+        U, S, V = svd_top(matrix, rank, randomized)
         # Retain only the top 'rank' singular values
         S = torch.diag(S[:rank])
         U = U[:, :rank]
@@ -67,6 +78,13 @@ def low_rank_approximation(matrix, rank):
         return low_rank_matrix
 
 
+def batched_low_rank_approximation(matrices, rank, randomized=False):
+    # Same as low_rank_approximation, but for a (batch, m, n) stack of matrices,
+    # so a single batched SVD replaces one small SVD launch per matrix.
+    U, S, V = svd_top(matrices, rank, randomized)
+    return (U[..., :rank] * S[..., None, :rank]) @ V[..., :rank].mT
+
+
 def compute_norm_shannon_entropy(weight_matrix):
     abs_weights = torch.abs(weight_matrix)
     l1_norm = torch.sum(abs_weights)
@@ -75,6 +93,56 @@ def compute_norm_shannon_entropy(weight_matrix):
     entropy = -torch.sum(abs_weights * log_abs_weights).item()
     return entropy
 
+def snapshot_state_dict(model, buffer):
+    """Copy the state dict of `model` into the flat CPU `buffer` and return a
+    copy of it as a state dict whose tensors are views of one contiguous storage.
+    """
+    shapes = {}
+    offset = 0
+    for name, tensor in model.state_dict().items():
+        buffer[offset:offset + tensor.numel()].copy_(tensor.reshape(-1), non_blocking=True)
+        shapes[name] = (offset, tensor.shape)
+        offset += tensor.numel()
+    if buffer.is_pinned():
+        # the copies above are asynchronous
+        torch.cuda.synchronize()
+
+    flat = buffer[:offset].clone()
+    return {name: flat[start:start + shape.numel()].view(shape) for name, (start, shape) in shapes.items()}
+
+def plot_train_val(fig, steps, train, val, ylabel, filename):
+    """Plot train/val curves to `filename` on the reusable Figure `fig`. Uses a
+    standalone Figure instead of pyplot so it can run on the background
+    plotting thread.
+    """
+    ax = fig.subplots()
+    ax.plot(steps, train, label="train")
+    ax.plot(steps, val, label="val")
+    ax.legend()
+    ax.set_title("Modular Multiplication (training on 50% of data)")
+    ax.set_xlabel("Optimization Steps")
+    ax.set_ylabel(ylabel)
+    ax.set_xscale("log", base=10)
+    ax.grid()
+    fig.savefig(filename, dpi=150)
+    fig.clear()
+
+def plot_layer_ranks(fig, steps, layer_matrix_ranks, layer_inspected, filename):
+    """Plot the normalized effective rank of each weight matrix of the
+    inspected layer to `filename` on the reusable Figure `fig`.
+    """
+    ax = fig.subplots()
+    for name, value in layer_matrix_ranks.items():
+        ax.plot(steps, value, label=f"matrix_{name}")
+    ax.legend()
+    ax.set_title(f"normalized effective ranks on layer_{layer_inspected}")
+    ax.set_xlabel("Optimization Steps")
+    ax.set_ylabel("normalized ranks")
+    ax.set_xscale("log", base=10)
+    ax.grid()
+    fig.savefig(filename, dpi=150)
+    fig.clear()
+
 def plot_attention_maps(attention_maps, epoch):
     saved_filenames = []
     for layer_idx, layer_attentions in enumerate(attention_maps):
@@ -83,7 +151,7 @@ def plot_attention_maps(attention_maps, epoch):
             # Average across the batch dimension
             avg_attention = layer_attentions.mean(dim=0)  # Shape will be (L, S) after averaging
             plt.figure(figsize=(6, 6))
-            sns.heatmap(avg_attention.detach().cpu().numpy(), cmap="coolwarm")
+            sns.heatmap(avg_attention.detach().float().cpu().numpy(), cmap="coolwarm")
             plt.title(f'Optimization step {epoch} - Layer {layer_idx + 1} (averaged over batch)')
             plt.xlabel('Input Sequence Position')
             plt.ylabel('Input Sequence Position')